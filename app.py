@@ -1,8 +1,15 @@
 import streamlit as st
 import pandas as pd
 import google.generativeai as genai
+import contextlib
+import os
 import re
+import time
+import uuid
+import json
+from typing import NamedTuple
 import plotly.express as px
+import plotly.graph_objects as go
 
 # --- ページ設定 ---
 st.set_page_config(
@@ -11,11 +18,65 @@ st.set_page_config(
     layout="wide"
 )
 
+# --- データ型 ---
+class RecipeEntry(NamedTuple):
+    """レシピ履歴の1件分。辞書より省メモリで、属性アクセスで参照できる。"""
+    timestamp: str
+    title: str
+    recipe_text: str
+    nutrition_info: dict
+    inputs: dict
+    inputs_json: str  # 履歴表示用に、保存時に一度だけ整形しておいた inputs のJSON文字列
+
 # --- ユーティリティ関数 ---
+# Trueにすると、栄養情報の抽出結果をサイドバーに表示する（デバッグ用）
+DEBUG = False
+
+# 各栄養素に対応する正規表現パターンを1つにまとめ、モジュール読み込み時に一度だけコンパイル。
+# テキストを1回走査するだけで全栄養素を検出できるよう、名前付きグループで栄養素を区別する。
+# AIの出力が「カロリー：350kcal」のように全角コロンで出力される可能性も考慮し、
+# コロンの前後に\s*（空白文字0回以上）を追加し、コロン自体も全角半角両方に対応
+_NUTRITION_PATTERN = re.compile(
+    r"カロリー\s*[：:]\s*(?P<cal>\d+(?:\.\d+)?)\s*kcal"
+    r"|タンパク質\s*[：:]\s*(?P<pro>\d+(?:\.\d+)?)\s*g"
+    r"|脂質\s*[：:]\s*(?P<fat>\d+(?:\.\d+)?)\s*g"
+    r"|炭水化物\s*[：:]\s*(?P<carb>\d+(?:\.\d+)?)\s*g"
+)
+
+# 名前付きグループ名と栄養情報のキーの対応
+_NUTRITION_GROUP_KEYS = {
+    "cal": "カロリー(kcal)",
+    "pro": "タンパク質(g)",
+    "fat": "脂質(g)",
+    "carb": "炭水化物(g)",
+}
+
+def _scan_nutrition(text):
+    """
+    テキストを1回走査し、見つかった栄養素の値を {キー: 値} の辞書で返す関数。
+    同じ栄養素が複数回現れた場合は、最初に見つかった値を採用する。
+    """
+    found = {}
+    for match in _NUTRITION_PATTERN.finditer(text):
+        group = match.lastgroup
+        key = _NUTRITION_GROUP_KEYS[group]
+        if key in found:
+            continue
+        # パターンが数値のみにマッチするため、float変換は失敗しない
+        found[key] = float(match.group(group))
+        # 全栄養素が見つかったら、残りのテキストは走査しない
+        if len(found) == len(_NUTRITION_GROUP_KEYS):
+            break
+    return found
+
 def extract_nutrition_info(text):
     """
     AIが生成したテキストから栄養情報を抽出する関数。
     正規表現を使って「カロリー: XXXkcal」「タンパク質: YYYg」などの形式を検出。
+    栄養情報はプロンプトで末尾の「栄養情報：」欄に書くよう指示しているため、「栄養情報」で区切った各区間を
+    末尾から順に走査し、最も多くの値が見つかった区間（同数なら後ろの区間）の値を優先する。
+    これにより、本文中の数値や、欄の後ろの「※栄養情報は目安です」のような注記の数値を誤って拾わない。
+    区間で見つからなかった栄養素だけ、テキスト全体を走査して補う。
     """
     nutrition = {
         "カロリー(kcal)": 0.0, # float型で初期化
@@ -24,40 +85,312 @@ def extract_nutrition_info(text):
         "炭水化物(g)": 0.0
     }
 
-    # 各栄養素に対応する正規表現パターン
-    # AIの出力が「カロリー：350kcal」のように全角コロンで出力される可能性も考慮し、
-    # コロンの前後に\s*（空白文字0回以上）を追加し、コロン自体も全角半角両方に対応
-    patterns = {
-        "カロリー(kcal)": r"カロリー\s*[：:]\s*(\d+(\.\d+)?)\s*kcal",
-        "タンパク質(g)": r"タンパク質\s*[：:]\s*(\d+(\.\d+)?)\s*g",
-        "脂質(g)": r"脂質\s*[：:]\s*(\d+(\.\d+)?)\s*g",
-        "炭水化物(g)": r"炭水化物\s*[：:]\s*(\d+(\.\d+)?)\s*g"
-    }
+    found = {}
+    section_end = len(text)
+    section_start = text.rfind("栄養情報")
+    while section_start >= 0 and len(found) < len(_NUTRITION_GROUP_KEYS):
+        section_found = _scan_nutrition(text[section_start:section_end])
+        if len(section_found) > len(found):
+            found = section_found
+        section_end = section_start
+        section_start = text.rfind("栄養情報", 0, section_start)
+    if len(found) < len(_NUTRITION_GROUP_KEYS):
+        found = {**_scan_nutrition(text), **found}
+    nutrition.update(found)
+    return nutrition
+
+# 食材入力の区切り文字（改行・半角/全角カンマ・読点）
+_INGREDIENT_SEPARATOR = re.compile(r"[,\n、，]+")
 
-    
-    for key, pattern in patterns.items():
-        match = re.search(pattern, text)
-        if match:
+def format_ingredients(text):
+    """
+    改行やカンマ（全角・読点を含む）で区切られた食材入力を「, 」区切りの1行に整形する関数。
+    空の項目は取り除く。
+    """
+    return ", ".join(part.strip() for part in _INGREDIENT_SEPARATOR.split(text) if part.strip())
+
+def extract_recipe_title(text):
+    """
+    AIが生成したテキストの1行目からレシピ名を取り出す関数。
+    「レシピ名：」が含まれない場合は「不明なレシピ」を返す。
+    """
+    if "レシピ名：" not in text:
+        return "不明なレシピ"
+    return text.split("\n", 1)[0].replace("レシピ名：", "").strip()
+
+NUTRIENT_KEYS = ["カロリー(kcal)", "タンパク質(g)", "脂質(g)", "炭水化物(g)"]
+NUTRITION_COLUMNS = ["日付", "レシピ名"] + NUTRIENT_KEYS
+MACRO_NUTRIENTS = ["タンパク質(g)", "脂質(g)", "炭水化物(g)"]
+
+# Trueにすると、栄養データをファイルに保存し、次回以降のセッションで読み込む。
+# 保存先はアプリを実行しているマシン上の全セッションで共有されるため、1人で使うローカル環境向け。
+# 複数のユーザーが利用するデプロイでは、他のユーザーの記録が見えてしまうので False のままにすること。
+PERSIST_NUTRITION_DATA = False
+
+# 栄養データの保存先ディレクトリ（Parquet形式）。
+# 保存時は1行ずつ別のファイル（パートファイル）として追記するため、複数のセッションが同時に保存しても
+# 互いのデータを上書きしない。パートファイルは読み込み時に1つのファイルへまとめる。
+NUTRITION_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "nutrition_data")
+NUTRITION_DATA_FILE = os.path.join(NUTRITION_DATA_DIR, "nutrition_data.parquet")
+_NUTRITION_LOCK_FILE = os.path.join(NUTRITION_DATA_DIR, ".lock")
+# これより古いロックファイルは、異常終了したプロセスが残したものとみなして削除する
+_NUTRITION_LOCK_STALE_SECONDS = 60
+
+@contextlib.contextmanager
+def _nutrition_data_lock(timeout=5.0):
+    """
+    パートファイルをまとめる処理を、同時に1つのプロセス・セッションだけが行うためのロック。
+    ロックファイルの排他的作成で実現しているため、OSに依存しない。
+    timeout 秒以内に取得できなければ TimeoutError（OSErrorのサブクラス）を送出する。
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            os.close(os.open(_NUTRITION_LOCK_FILE, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            break
+        except FileExistsError:
             try:
-                value = float(match.group(1))
-                nutrition[key] = value
-                st.sidebar.write(f"✅ {key}: {value} (抽出成功)")
-            except ValueError:
-                st.sidebar.write(f"❌ {key}: 値の変換失敗 (マッチ: {match.group(1)})")
+                if time.time() - os.path.getmtime(_NUTRITION_LOCK_FILE) > _NUTRITION_LOCK_STALE_SECONDS:
+                    os.remove(_NUTRITION_LOCK_FILE)
+                    continue
+            except FileNotFoundError:
+                continue
+            if time.monotonic() > deadline:
+                raise TimeoutError("栄養データのロックを取得できませんでした")
+            time.sleep(0.05)
+    try:
+        yield
+    finally:
+        os.remove(_NUTRITION_LOCK_FILE)
+
+def _compact_nutrition_data():
+    """
+    保存済みのファイルとパートファイルを読み込み、1つのファイルにまとめて保存した順の行リストを返す関数。
+    ロックを取得した状態で呼び出すこと。
+    """
+    part_names = sorted(
+        name for name in os.listdir(NUTRITION_DATA_DIR)
+        if name.endswith(".parquet") and not name.startswith(".")
+        and name != os.path.basename(NUTRITION_DATA_FILE)
+    )
+    frames = []
+    if os.path.exists(NUTRITION_DATA_FILE):
+        frames.append(pd.read_parquet(NUTRITION_DATA_FILE, columns=NUTRITION_COLUMNS, memory_map=True))
+    for name in part_names:
+        frames.append(pd.read_parquet(os.path.join(NUTRITION_DATA_DIR, name), columns=NUTRITION_COLUMNS))
+    if not frames:
+        return []
+    df = pd.concat(frames, ignore_index=True)
+    if part_names:
+        # 一時ファイルに書き込んでから置き換え、まとめ終わったパートファイルを削除する
+        tmp_path = os.path.join(NUTRITION_DATA_DIR, ".nutrition_data.parquet.tmp")
+        df.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, NUTRITION_DATA_FILE)
+        for name in part_names:
+            os.remove(os.path.join(NUTRITION_DATA_DIR, name))
+    return df.to_dict("records")
+
+def load_nutrition_rows():
+    """
+    保存済みの栄養データを行(dict)のリストとして、保存した順に読み込む関数。
+    読み込みと同時にパートファイルを1つのファイルにまとめるため、読み込むファイル数は増え続けない。
+    保存先がない場合や読み込みに失敗した場合は空のリストを返す。
+    """
+    if not os.path.isdir(NUTRITION_DATA_DIR):
+        return []
+    try:
+        with _nutrition_data_lock():
+            return _compact_nutrition_data()
+    except (OSError, ValueError, ImportError) as e:
+        st.warning(f"保存済みの栄養データを読み込めませんでした: {e}")
+        return []
+
+def save_nutrition_row(row):
+    """
+    栄養データの1行を、保存先ディレクトリに新しいパートファイルとして書き込む関数。
+    一時ファイルに書き込んでから os.replace で置き換えるため、途中で失敗しても壊れたファイルは残らない。
+    ファイル名は保存時刻から始まるため、まとめる際は保存した順に並ぶ。
+    """
+    os.makedirs(NUTRITION_DATA_DIR, exist_ok=True)
+    name = f"{time.time_ns():020d}-{uuid.uuid4().hex}.parquet"
+    tmp_path = os.path.join(NUTRITION_DATA_DIR, f".{name}.tmp")
+    try:
+        pd.DataFrame([row], columns=NUTRITION_COLUMNS).to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, os.path.join(NUTRITION_DATA_DIR, name))
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def _accumulate_nutrition_row(row):
+    """
+    栄養データに1行追加し、全期間の三大栄養素の合計と日ごとの合計に加算する関数。
+    合計を追加時に更新しておくことで、表示時の再集計を不要にする。
+    """
+    st.session_state.nutrition_rows.append(row)
+    totals = st.session_state.nutrient_totals
+    for key in totals:
+        totals[key] += row[key]
+    day_totals = st.session_state.daily_totals.setdefault(
+        row["日付"], {key: 0.0 for key in NUTRIENT_KEYS}
+    )
+    for key in NUTRIENT_KEYS:
+        day_totals[key] += row[key]
+
+def add_nutrition_row(row):
+    """
+    栄養データに1行追加し、データのバージョンを更新する関数。
+    バージョンが変わると、集計結果などのキャッシュが無効化される。
+    PERSIST_NUTRITION_DATA が True の場合は、追加した行をファイルにも保存する。
+    """
+    _accumulate_nutrition_row(row)
+    st.session_state.nutrition_version += 1
+    if not PERSIST_NUTRITION_DATA:
+        return
+    try:
+        save_nutrition_row(row)
+    except (OSError, ValueError, ImportError) as e:
+        st.warning(f"栄養データをファイルに保存できませんでした（このセッション中は保持されます）: {e}")
+
+def _nutrition_cache():
+    """
+    栄養データから計算した結果を保持するセッションごとのキャッシュを返す関数。
+    データのバージョンが変わっていれば、キャッシュを空にしてから返す。
+    """
+    version = st.session_state.nutrition_version
+    if st.session_state.get("nutrition_cache_version") != version:
+        st.session_state.nutrition_cache = {}
+        st.session_state.nutrition_cache_version = version
+    return st.session_state.nutrition_cache
+
+def get_nutrition_df():
+    """
+    セッションに蓄積された栄養データの行リストをDataFrameに変換する関数。
+    データが更新されていなければ、前回変換したDataFrameを再利用する。
+    """
+    cache = _nutrition_cache()
+    if "df" not in cache:
+        cache["df"] = pd.DataFrame(st.session_state.nutrition_rows, columns=NUTRITION_COLUMNS)
+    return cache["df"]
+
+def get_nutrition_csv():
+    """栄養データをUTF-8のCSVバイト列に変換して返す（データ更新時のみ再エンコード）。"""
+    cache = _nutrition_cache()
+    if "csv" not in cache:
+        cache["csv"] = get_nutrition_df().to_csv(index=False).encode('utf-8')
+    return cache["csv"]
+
+def compute_daily_summary():
+    """日付ごとに栄養データを合計したDataFrameを返す（データ更新時のみ再計算）。"""
+    cache = _nutrition_cache()
+    if "daily_summary" not in cache:
+        daily_summary = pd.DataFrame.from_dict(
+            st.session_state.daily_totals, orient="index", columns=NUTRIENT_KEYS
+        ).sort_index()
+        daily_summary.index.name = "日付"
+        cache["daily_summary"] = daily_summary
+    return cache["daily_summary"]
+
+# 折れ線グラフの日数がこれを超えたら、週ごとの平均に間引いて表示する
+LINE_CHART_MAX_DAYS = 180
+
+def build_line_fig(nutrient):
+    """日ごとの栄養摂取量のトレンドを表す折れ線グラフを返す（データ更新時・栄養素変更時のみ再生成）。"""
+    cache = _nutrition_cache()
+    key = ("line_fig", nutrient)
+    if key not in cache:
+        plot_data_line = compute_daily_summary().reset_index()
+        if len(plot_data_line) > LINE_CHART_MAX_DAYS:
+            # 長期間の履歴は週平均に間引いて、描画する点の数を抑える
+            plot_data_line["日付"] = pd.to_datetime(plot_data_line["日付"])
+            plot_data_line = plot_data_line.set_index("日付").resample("W").mean().dropna().reset_index()
+            title = f"週ごとの{nutrient}摂取量（1日あたりの平均）"
+            y_label = f"{nutrient} (週平均)"
+            dtick = None
+            # 180日を超える期間は年をまたぐため、年も表示する
+            tickformat = "%Y/%m/%d"
         else:
-            st.sidebar.write(f"❌ {key}: パターン不一致")
+            title = f"日ごとの{nutrient}摂取量"
+            y_label = f"{nutrient} (合計)"
+            dtick = "D1"
+            tickformat = "%m/%d"
+        fig_line = px.line(
+            plot_data_line,
+            x="日付",
+            y=nutrient,
+            title=title,
+            labels={"日付": "日付", nutrient: y_label},
+            render_mode="webgl"
+        )
+        fig_line.update_xaxes(dtick=dtick, tickformat=tickformat)
+        cache[key] = fig_line
+    return cache[key]
+
+def build_totals_figs():
+    """三大栄養素の合計量の棒グラフと割合の円グラフを返す（データ更新時のみ再生成）。"""
+    cache = _nutrition_cache()
+    if "totals_figs" not in cache:
+        # 3項目だけの固定形状の図なので、px を介さず graph_objects で直接組み立てる
+        labels = list(st.session_state.nutrient_totals.keys())
+        values = list(st.session_state.nutrient_totals.values())
+        fig_bar = go.Figure(go.Bar(x=labels, y=values))
+        fig_bar.update_layout(
+            title="主要栄養素の合計量",
+            xaxis_title="栄養素",
+            yaxis_title="合計摂取量 (g)"
+        )
+        fig_pie = go.Figure(go.Pie(labels=labels, values=values, hole=0.3))
+        fig_pie.update_layout(title="三大栄養素の割合")
+        cache["totals_figs"] = (fig_bar, fig_pie)
+    return cache["totals_figs"]
 
+@st.cache_resource
+def get_gemini_model(api_key):
+    """
+    APIキーを設定してGeminiのモデルを生成する関数。
+    APIキーごとに1度だけ実行され、以降の再実行では生成済みのモデルを再利用する。
 
-    return nutrition
+    注意: genai.configure() はプロセス全体で共有される設定を書き換え、モデルは最初の生成時に
+    その時点の設定のAPIキーで通信を始める。このアプリは1つのデプロイにつき1つのAPIキー
+    （secrets.toml の GEMINI_API_KEY）で運用することを前提としており、複数のユーザーが
+    別々のキーを入力すると、他のユーザーのキーで通信する場合がある。
+    """
+    genai.configure(api_key=api_key)
+    return genai.GenerativeModel('gemini-1.5-flash')
+
+# レシピ履歴タブで一度に表示する件数
+HISTORY_PAGE_SIZE = 20
+
+def show_more_history():
+    """レシピ履歴の表示件数を1ページ分増やす（「さらに表示」ボタンのコールバック）。"""
+    st.session_state.history_limit += HISTORY_PAGE_SIZE
 
 # --- セッションステートの初期化 ---
 if "generated_recipes" not in st.session_state:
     st.session_state.generated_recipes = []
 
-if "nutrition_data" not in st.session_state:
-    st.session_state.nutrition_data = pd.DataFrame(
-        columns=["日付", "レシピ名", "カロリー(kcal)", "タンパク質(g)", "脂質(g)", "炭水化物(g)"]
-    )
+# 全期間の三大栄養素の合計（行の追加時に加算していく）
+if "nutrient_totals" not in st.session_state:
+    st.session_state.nutrient_totals = {key: 0.0 for key in MACRO_NUTRIENTS}
+
+# 日付ごとの各栄養素の合計（行の追加時に加算していく）
+if "daily_totals" not in st.session_state:
+    st.session_state.daily_totals = {}
+
+# 栄養データが追加されるたびに増えるカウンタ（集計結果のキャッシュキーとして使用）
+if "nutrition_version" not in st.session_state:
+    st.session_state.nutrition_version = 0
+
+# 栄養データは行(dict)のリストとして保持し、DataFrameへの変換は表示時にのみ行う。
+# PERSIST_NUTRITION_DATA が True の場合は、セッション開始時に保存済みの栄養データを読み込んで合計を復元する。
+if "nutrition_rows" not in st.session_state:
+    st.session_state.nutrition_rows = []
+    if PERSIST_NUTRITION_DATA:
+        for row in load_nutrition_rows():
+            _accumulate_nutrition_row(row)
+
+# レシピ履歴タブで表示する件数（「さらに表示」で増える）
+if "history_limit" not in st.session_state:
+    st.session_state.history_limit = HISTORY_PAGE_SIZE
 
 # --- サイドバー (APIキー入力とアプリ情報) ---
 st.sidebar.header("アプリ設定")
@@ -72,10 +405,8 @@ except KeyError:
     )
 
 if gemini_api_key:
-    genai.configure(api_key=gemini_api_key)
+    st.session_state.gemini_model = get_gemini_model(gemini_api_key)
     st.sidebar.success("Gemini APIキーが設定されました。")
-    if "gemini_model" not in st.session_state:
-        st.session_state.gemini_model = genai.GenerativeModel('gemini-1.5-flash')
 else:
     st.sidebar.warning("Gemini APIキーを設定してください。AI機能は利用できません。")
 
@@ -130,7 +461,7 @@ with tab1:
             else:
                 with st.spinner("AIが最高のレシピを考案中です..."):
                     try:
-                        formatted_ingredients = ", ".join([ing.strip() for ing in ingredients_input.split(',') if ing.strip()])
+                        formatted_ingredients = format_ingredients(ingredients_input)
 
                         prompt = f"""あなたは優秀な料理研究家であり、栄養士でもあります。
                         以下の情報を元に、健康的で美味しいレシピを考案してください。
@@ -153,41 +484,49 @@ with tab1:
                         栄養情報：
                         """
 
-                        response = st.session_state.gemini_model.generate_content(prompt)
-                        recipe_text = response.text
+                        # ストリーミングで受信し、届いた部分から順に表示する
+                        response = st.session_state.gemini_model.generate_content(prompt, stream=True)
 
                         st.subheader("🎉 AIが提案するレシピです！")
-                        st.markdown(recipe_text)
+                        recipe_placeholder = st.empty()
+                        chunks = []
+                        for chunk in response:
+                            chunks.append(chunk.text)
+                            recipe_placeholder.markdown("".join(chunks))
+                        recipe_text = "".join(chunks)
 
                 
                         nutrition_values = extract_nutrition_info(recipe_text) # 抽出関数を呼び出し
+                        if DEBUG:
+                            st.sidebar.write("栄養情報の抽出結果（見つからなかった項目は0.0）:", nutrition_values)
+                        recipe_title = extract_recipe_title(recipe_text)
                     
                         new_nutrition_row = {
                             "日付": pd.Timestamp.now().strftime("%Y-%m-%d"),
-                            "レシピ名": recipe_text.splitlines()[0].replace("レシピ名：", "").strip() if "レシピ名：" in recipe_text else "不明なレシピ",
+                            "レシピ名": recipe_title,
                             "カロリー(kcal)": nutrition_values["カロリー(kcal)"],
                             "タンパク質(g)": nutrition_values["タンパク質(g)"],
                             "脂質(g)": nutrition_values["脂質(g)"],
                             "炭水化物(g)": nutrition_values["炭水化物(g)"]
                         }
                         
-                        st.session_state.nutrition_data = pd.concat([
-                            st.session_state.nutrition_data,
-                            pd.DataFrame([new_nutrition_row])
-                        ], ignore_index=True)
-
-                        st.session_state.generated_recipes.append({
-                            "inputs": {
-                                "食材": ingredients_input,
-                                "ジャンル": genre,
-                                "目的": purpose,
-                                "時間": cooking_time,
-                                "アレルギー": allergies
-                            },
-                            "recipe_text": recipe_text,
-                            "nutrition_info": nutrition_values,
-                            "timestamp": pd.Timestamp.now().strftime("%Y-%m-%d %H:%M:%S")
-                        })
+                        add_nutrition_row(new_nutrition_row)
+
+                        recipe_inputs = {
+                            "食材": ingredients_input,
+                            "ジャンル": genre,
+                            "目的": purpose,
+                            "時間": cooking_time,
+                            "アレルギー": allergies
+                        }
+                        st.session_state.generated_recipes.append(RecipeEntry(
+                            timestamp=pd.Timestamp.now().strftime("%Y-%m-%d %H:%M:%S"),
+                            title=recipe_title,
+                            recipe_text=recipe_text,
+                            nutrition_info=nutrition_values,
+                            inputs=recipe_inputs,
+                            inputs_json=json.dumps(recipe_inputs, ensure_ascii=False, indent=2)
+                        ))
                         st.success("レシピが生成され、履歴と栄養データに保存されました！")
 
                     except Exception as e:
@@ -196,12 +535,14 @@ with tab1:
     else:
         st.info("AIレシピ生成機能を利用するには、サイドバーでGemini APIキーを設定してください。")
 
-with tab2:
+@st.fragment  # タブ内の操作では、このタブだけを再実行する
+def render_nutrition_tab():
     st.header("📊 栄養管理")
     st.write("記録された食事の栄養データを閲覧・分析できます。")
 
 
-    if not st.session_state.nutrition_data.empty:
+    if st.session_state.nutrition_rows:
+        nutrition_df = get_nutrition_df()
         display_option = st.radio(
             "データの表示形式を選択してください:",
             ("詳細データ", "日ごとのサマリー"),
@@ -211,13 +552,9 @@ with tab2:
 
         if display_option == "詳細データ":
             st.subheader("記録されたすべての栄養データ")
-            st.dataframe(st.session_state.nutrition_data, use_container_width=True)
-            
-            @st.cache_data
-            def convert_df_to_csv(df):
-                return df.to_csv(index=False).encode('utf-8')
+            st.dataframe(nutrition_df, use_container_width=True)
 
-            csv = convert_df_to_csv(st.session_state.nutrition_data)
+            csv = get_nutrition_csv()
             st.download_button(
                 label="栄養データをCSVでダウンロード",
                 data=csv,
@@ -227,7 +564,7 @@ with tab2:
 
         elif display_option == "日ごとのサマリー":
             st.subheader("日ごとの栄養サマリー")
-            daily_summary = st.session_state.nutrition_data.groupby("日付").sum(numeric_only=True)
+            daily_summary = compute_daily_summary()
             st.dataframe(daily_summary, use_container_width=True)
 
             st.subheader("栄養摂取量のトレンドと内訳")
@@ -235,68 +572,48 @@ with tab2:
             st.markdown("##### 日ごとの栄養摂取量のトレンド")
             nutrient_to_plot_line = st.selectbox(
                 "トレンド表示する栄養素を選択してください:",
-                ["カロリー(kcal)", "タンパク質(g)", "脂質(g)", "炭水化物(g)"],
+                NUTRIENT_KEYS,
                 key="nutrient_line_selector"
             )
             if not daily_summary.empty:
-                plot_data_line = daily_summary.reset_index()
-                fig_line = px.line(
-                    plot_data_line,
-                    x="日付",
-                    y=nutrient_to_plot_line,
-                    title=f"日ごとの{nutrient_to_plot_line}摂取量",
-                    labels={"日付": "日付", nutrient_to_plot_line: f"{nutrient_to_plot_line} (合計)"}
-                )
-                fig_line.update_xaxes(dtick="D1", tickformat="%m/%d")
+                fig_line = build_line_fig(nutrient_to_plot_line)
                 st.plotly_chart(fig_line, use_container_width=True)
             
             st.markdown("---")
             
             st.markdown("##### 主要栄養素の合計内訳（全期間）")
-            total_nutrition = st.session_state.nutrition_data[["タンパク質(g)", "脂質(g)", "炭水化物(g)"]].sum().reset_index()
-            total_nutrition.columns = ["栄養素", "合計量(g)"]
-
-            if not total_nutrition.empty:
-                fig_bar = px.bar(
-                    total_nutrition,
-                    x="栄養素",
-                    y="合計量(g)",
-                    title="主要栄養素の合計量",
-                    labels={"栄養素": "栄養素", "合計量(g)": "合計摂取量 (g)"}
-                )
-                st.plotly_chart(fig_bar, use_container_width=True)
-
-                st.markdown("##### 三大栄養素の割合")
-                fig_pie = px.pie(
-                    total_nutrition,
-                    values="合計量(g)",
-                    names="栄養素",
-                    title="三大栄養素の割合",
-                    hole=0.3
-                )
-                st.plotly_chart(fig_pie, use_container_width=True)
-                
-            else:
-                st.info("まだ栄養データがありません。レシピを生成して記録しましょう！")
+            fig_bar, fig_pie = build_totals_figs()
+            st.plotly_chart(fig_bar, use_container_width=True)
+
+            st.markdown("##### 三大栄養素の割合")
+            st.plotly_chart(fig_pie, use_container_width=True)
 
     else:
         st.info("まだ栄養データがありません。レシピを生成して記録しましょう！")
 
-with tab3:
+with tab2:
+    render_nutrition_tab()
+
+@st.fragment  # タブ内の操作では、このタブだけを再実行する
+def render_history_tab():
     st.header("📚 レシピ履歴")
     st.write("これまでに生成・保存したレシピを閲覧できます。")
 
     if st.session_state.generated_recipes:
-        for i, recipe_entry in enumerate(reversed(st.session_state.generated_recipes)):
-            recipe_key = f"recipe_{i}_{recipe_entry['timestamp']}"
+        # 新しい順に、最大 history_limit 件だけを表示する
+        recipes = st.session_state.generated_recipes
+        n = len(recipes)
+        oldest_shown = max(0, n - st.session_state.history_limit)
+        for idx in range(n - 1, oldest_shown - 1, -1):
+            recipe_entry = recipes[idx]
             
-            with st.expander(f"**{recipe_entry['timestamp']}** - {recipe_entry['recipe_text'].splitlines()[0].replace('レシピ名：', '').strip()}"):
-                st.markdown(recipe_entry["recipe_text"])
+            with st.expander(f"**{recipe_entry.timestamp}** - {recipe_entry.title}"):
+                st.markdown(recipe_entry.recipe_text)
                 
-                if "nutrition_info" in recipe_entry and isinstance(recipe_entry["nutrition_info"], dict):
+                if isinstance(recipe_entry.nutrition_info, dict):
                     st.markdown("---")
                     st.subheader("💡 栄養情報")
-                    nut_info = recipe_entry["nutrition_info"]
+                    nut_info = recipe_entry.nutrition_info
                     
                     # 各栄養素が存在するかチェックし、表示
                     # .get() を使うとキーが存在しない場合にエラーにならない
@@ -307,6 +624,16 @@ with tab3:
                 
                 st.markdown("---")
                 st.subheader("入力情報")
-                st.json(recipe_entry["inputs"])
+                st.code(recipe_entry.inputs_json, language="json")
+
+        if oldest_shown > 0:
+            st.button(
+                f"さらに表示（残り{oldest_shown}件）",
+                on_click=show_more_history,
+                key="show_more_history_button"
+            )
     else:
-        st.info("まだレシピが生成されていません。レシピ生成タブで新しいレシピを作成しましょう！")
\ No newline at end of file
+        st.info("まだレシピが生成されていません。レシピ生成タブで新しいレシピを作成しましょう！")
+
+with tab3:
+    render_history_tab()